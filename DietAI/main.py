@@ -7,10 +7,85 @@ Following instructions.txt (Steps 6-12, 17, 23) - MVP without RAG.
 import json
 import os
 import configparser
+import re
+import sys
+import time
+import jinja2
 from pathlib import Path
-from llama_cpp import Llama
+from typing import List, Optional, Tuple
+from llama_cpp import Llama, llama_supports_gpu_offload
+from llama_cpp.llama_chat_format import ChatFormatterResponse, Jinja2ChatFormatter
 from memory_manager import MemoryManager
 
+try:
+    import orjson  # Faster JSON parse/serialize; falls back to stdlib json
+except ImportError:
+    orjson = None  # type: ignore[assignment]
+
+try:
+    import ahocorasick  # Single-pass multi-keyword scanning; falls back to regex
+except ImportError:
+    ahocorasick = None  # type: ignore[assignment]
+
+
+# Step 23: Emergency keywords, matched case-insensitively in a single pass
+EMERGENCY_KEYWORDS = [
+    "anorexia", "suicide", "severe pain", "chest pain", 
+    "heart attack", "stroke", "emergency", "dying"
+]
+_EMERGENCY_RE = re.compile("|".join(map(re.escape, EMERGENCY_KEYWORDS)), re.IGNORECASE)
+
+# Step 23: Startup disclaimer, preassembled so it is written in one call
+DISCLAIMER_TEXT = (
+    "\n" + "="*80 + "\n"
+    "⚠️  IMPORTANT DISCLAIMER\n"
+    + "="*80 + "\n"
+    """
+This dietary assistant is an informational tool and is NOT a substitute for:
+- A licensed healthcare professional
+- A registered dietitian
+- Medical advice or treatment
+
+The recommendations provided are general guidance and should not replace 
+professional medical or nutritional advice. Always consult with qualified 
+healthcare providers for:
+- Chronic health conditions
+- Severe dietary restrictions
+- Medical concerns related to nutrition
+
+If you experience severe symptoms or have concerns about your health, 
+please seek immediate professional medical attention.
+"""
+    "\n" + "="*80 + "\n\n"
+)
+
+WELCOME_HEADER = (
+    "\n" + "="*80 + "\n"
+    "🍎 Welcome to DietAI - Your Personal Dietary Assistant\n"
+    + "="*80 + "\n"
+)
+
+WELCOME_COMMANDS = """💬 Ask me anything about diet, nutrition, meal planning, or recipes!
+
+📝 Commands:
+   /exit    - End conversation and save session
+   /clear   - Clear current session memory
+   /history - View conversation history
+   /goals   - View your preferences and blood report
+
+"""
+
+# Optional plural after an allergy word ("egg" -> "eggs", "peach" -> "peaches")
+_ALLERGY_SUFFIX_RE = re.compile(r"(?:s|es)?(?!\w)")
+
+# GGUF general.file_type values for unquantized weights (F32, F16, BF16)
+UNQUANTIZED_FILE_TYPES = {0: "F32", 1: "F16", 32: "BF16"}
+
+
+def _is_word_char(char: str) -> bool:
+    """Same notion of a word character as regex \\w"""
+    return char.isalnum() or char == "_"
+
 
 class DietAI:
     """Main DietAI application class"""
@@ -30,21 +105,54 @@ class DietAI:
         
         # Load LLM model
         model_path = self.config['model']['model_path']
+        # mmap lets the kernel page weights in lazily from the page cache;
+        # mlock pins them in RAM so they are never evicted (needs enough RAM)
+        use_mmap = self.config['model'].getboolean('use_mmap', True)
+        use_mlock = self.config['model'].getboolean('use_mlock', False)
+        # Thread count: 'auto' uses all cores, capped to avoid hyperthread contention
+        n_threads_setting = self.config['model'].get('n_threads', 'auto')
+        if n_threads_setting == 'auto':
+            n_threads = min(16, os.cpu_count() or 4)
+        else:
+            n_threads = int(n_threads_setting)
+        # Offload all layers (-1) when llama.cpp was built with Metal/CUDA, else CPU only
+        n_gpu_layers = int(self.config['model'].get('n_gpu_layers', -1))
+        if not llama_supports_gpu_offload():
+            n_gpu_layers = 0
         print(f"📦 Loading model from {model_path}...")
         self.llm = Llama(
             model_path=model_path,
             n_ctx=2048,
-            n_threads=4,
-            n_gpu_layers=0,
+            n_threads=n_threads,
+            n_threads_batch=n_threads,
+            n_batch=int(self.config['model'].get('n_batch', 2048)),
+            n_ubatch=int(self.config['model'].get('n_ubatch', 512)),
+            n_gpu_layers=n_gpu_layers,
+            use_mmap=use_mmap,
+            use_mlock=use_mlock,
             verbose=False,
             stream=True,
             max_tokens=200
         )
         
+        self._check_quantization(model_path)
+        
         # Load user data
         self.preferences = self._load_preferences()
         self.blood_report = self._load_blood_report()
         
+        # System prompt + personal context only change with the user data above,
+        # so build them once; an identical prefix each turn lets llama.cpp reuse its KV cache
+        self._static_prefix = self._build_system_prompt() + self._build_personal_context()
+        
+        # Render and tokenize the static prefix once so each turn only tokenizes
+        # the text after it (KV-cache prefix reuse is done by llama.cpp either way)
+        self._chat_formatter = self._build_chat_formatter()
+        self._prefix_text, self._prefix_tokens = self._tokenize_static_prefix()
+        
+        # Emergency keywords + the user's allergies, scanned together on every input
+        self._keyword_automaton = self._build_keyword_automaton()
+        
         # Initialize memory manager
         self.memory_manager = MemoryManager(config_path)
         
@@ -53,11 +161,99 @@ class DietAI:
         
         print("✅ DietAI ready!")
     
+    def _build_chat_formatter(self, add_generation_prompt: bool = True) -> Optional[Jinja2ChatFormatter]:
+        """
+        Build a formatter for the model's own chat template, if Llama() uses it.
+        
+        When llama-cpp-python recognised the template as a built-in format
+        (chatml, llama-3, ...) it formats chats with that instead, so return
+        None and keep create_chat_completion to get the exact same prompt.
+        """
+        template = self.llm.metadata.get('tokenizer.chat_template')
+        if not template or self.llm.chat_format != "chat_template.default":
+            return None
+        
+        # Same BOS/EOS handling as llama-cpp-python's own template handler
+        eos_id = self.llm.token_eos()
+        bos_id = self.llm.token_bos()
+        eos_token = (
+            self.llm.detokenize([eos_id], special=True).decode('utf-8', errors='ignore')
+            if eos_id != -1 else ""
+        )
+        bos_token = (
+            self.llm.detokenize([bos_id], special=True).decode('utf-8', errors='ignore')
+            if bos_id != -1 else ""
+        )
+        return Jinja2ChatFormatter(
+            template=template,
+            eos_token=eos_token,
+            bos_token=bos_token,
+            add_generation_prompt=add_generation_prompt,
+            stop_token_ids=[eos_id]
+        )
+    
+    def _tokenize_static_prefix(self) -> Tuple[str, List[int]]:
+        """Render the static system message through the chat template and tokenize it"""
+        formatter = self._build_chat_formatter(add_generation_prompt=False)
+        if formatter is None:
+            return "", []
+        
+        # Some templates reject a conversation without a user turn (raise_exception
+        # surfaces as ValueError); in that case each turn tokenizes the whole prompt
+        try:
+            result = formatter(messages=[{"role": "system", "content": self._static_prefix}])
+        except (jinja2.TemplateError, ValueError):
+            return "", []
+        
+        tokens = self.llm.tokenize(
+            result.prompt.encode('utf-8'), add_bos=not result.added_special, special=True
+        )
+        return result.prompt, tokens
+    
+    def _prompt_tokens(
+        self, formatter: Jinja2ChatFormatter, messages: List[dict]
+    ) -> Tuple[List[int], ChatFormatterResponse]:
+        """
+        Format messages with the chat template and tokenize them,
+        reusing the cached tokens of the static prefix
+        
+        Returns:
+            (prompt token ids, formatter result with stop sequences/criteria)
+        """
+        result = formatter(messages=messages)
+        
+        if self._prefix_tokens and result.prompt.startswith(self._prefix_text):
+            suffix = result.prompt[len(self._prefix_text):]
+            tokens = self._prefix_tokens + self.llm.tokenize(
+                suffix.encode('utf-8'), add_bos=False, special=True
+            )
+        else:
+            tokens = self.llm.tokenize(
+                result.prompt.encode('utf-8'), add_bos=not result.added_special, special=True
+            )
+        return tokens, result
+    
+    def _check_quantization(self, model_path: str):
+        """Warn if the model is an unquantized (F32/F16/BF16) GGUF"""
+        file_type = self.llm.metadata.get('general.file_type')
+        if file_type is not None:
+            precision = UNQUANTIZED_FILE_TYPES.get(int(file_type))
+        else:
+            # Older GGUFs may lack file_type; fall back to whole filename tokens
+            # (e.g. "model-bf16.gguf" -> {"model", "bf16", "gguf"}), so "bf16" is not read as F16
+            tokens = set(re.split(r"[^a-z0-9]+", Path(model_path).name.lower()))
+            precision = next((p for p in UNQUANTIZED_FILE_TYPES.values() if p.lower() in tokens), None)
+        
+        if precision:
+            print(f"⚠️  Model weights are unquantized ({precision}): expect ~4x slower decoding and RAM use vs Q4_K_M")
+            print("   Quantize with: llama-quantize input.gguf output-q4_k_m.gguf Q4_K_M")
+            print("   See https://github.com/ggml-org/llama.cpp/tree/master/tools/quantize")
+    
     def _load_preferences(self):
         """Load user preferences from JSON file"""
         try:
             with open(self.preferences_file, 'r') as f:
-                prefs = json.load(f)
+                prefs = orjson.loads(f.read()) if orjson else json.load(f)
                 print(f"📋 Loaded preferences: {prefs.get('dietary_style', 'Not specified')} diet")
                 return prefs
         except FileNotFoundError:
@@ -99,48 +295,42 @@ Note: You are not a registered dietitian or medical doctor."""
         
         return prompt
     
-    def _build_personal_context(self):
+    def _build_personal_context(self) -> str:
         """Build personal context from preferences and blood report"""
-        context = ""
+        parts: List[str] = []
         
         # Add preferences
         if self.preferences:
-            context += "\n\nUSER PREFERENCES:\n"
-            context += f"- Dietary Style: {self.preferences.get('dietary_style', 'Not specified')}\n"
+            parts.append("\n\nUSER PREFERENCES:\n")
+            parts.append(f"- Dietary Style: {self.preferences.get('dietary_style', 'Not specified')}\n")
             
             allergies = self.preferences.get('allergies', [])
             if allergies:
-                context += f"- Allergies: {', '.join(allergies)} (NEVER recommend these foods)\n"
+                parts.append(f"- Allergies: {', '.join(allergies)} (NEVER recommend these foods)\n")
             
             cuisines = self.preferences.get('cuisine_preferences', [])
             if cuisines:
-                context += f"- Preferred Cuisines: {', '.join(cuisines)}\n"
+                parts.append(f"- Preferred Cuisines: {', '.join(cuisines)}\n")
             
             macro_goals = self.preferences.get('macro_goals', {})
             if macro_goals:
-                context += f"- Macro Goals: {macro_goals.get('carbohydrates_percent', 0)}% carbs, "
-                context += f"{macro_goals.get('protein_percent', 0)}% protein, "
-                context += f"{macro_goals.get('fat_percent', 0)}% fat\n"
+                parts.append(f"- Macro Goals: {macro_goals.get('carbohydrates_percent', 0)}% carbs, ")
+                parts.append(f"{macro_goals.get('protein_percent', 0)}% protein, ")
+                parts.append(f"{macro_goals.get('fat_percent', 0)}% fat\n")
         
         # Add blood report
         if self.blood_report:
-            context += "\n\nBLOOD REPORT DATA:\n"
-            context += self.blood_report
-            context += "\n\nIMPORTANT: All recommendations must consider the blood report metrics above."
+            parts.append("\n\nBLOOD REPORT DATA:\n")
+            parts.append(self.blood_report)
+            parts.append("\n\nIMPORTANT: All recommendations must consider the blood report metrics above.")
         
-        return context
+        return "".join(parts)
     
     def _build_complete_prompt(self, user_query: str):
         """
         Step 11: Construct Prompt
         Build complete prompt with all context in priority order
         """
-        # System prompt (highest priority)
-        system_prompt = self._build_system_prompt()
-        
-        # Personal context (preferences + blood report)
-        personal_context = self._build_personal_context()
-        
         # Long-term memory
         long_term_memory = self.long_term_context if self.long_term_context else ""
         
@@ -149,7 +339,8 @@ Note: You are not a registered dietitian or medical doctor."""
         
         # Build messages for chat completion
         messages = [
-            {"role": "system", "content": system_prompt + personal_context}
+            # System prompt (highest priority) + personal context (preferences + blood report)
+            {"role": "system", "content": self._static_prefix}
         ]
         
         # Add long-term memory if available
@@ -176,45 +367,68 @@ Note: You are not a registered dietitian or medical doctor."""
         Step 23: Add Dietary Disclaimer System
         Display disclaimer at startup
         """
-        print("\n" + "="*80)
-        print("⚠️  IMPORTANT DISCLAIMER")
-        print("="*80)
-        print("""
-This dietary assistant is an informational tool and is NOT a substitute for:
-- A licensed healthcare professional
-- A registered dietitian
-- Medical advice or treatment
-
-The recommendations provided are general guidance and should not replace 
-professional medical or nutritional advice. Always consult with qualified 
-healthcare providers for:
-- Chronic health conditions
-- Severe dietary restrictions
-- Medical concerns related to nutrition
-
-If you experience severe symptoms or have concerns about your health, 
-please seek immediate professional medical attention.
-        """)
-        print("="*80)
-        print()
+        sys.stdout.write(DISCLAIMER_TEXT)
+    
+    def _build_keyword_automaton(self):
+        """Compile emergency keywords and allergies into one Aho-Corasick automaton"""
+        if ahocorasick is None:
+            return None
+        
+        automaton = ahocorasick.Automaton()
+        for allergy in self.preferences.get('allergies', []):
+            automaton.add_word(allergy.lower(), ("allergy", allergy))
+        for keyword in EMERGENCY_KEYWORDS:
+            automaton.add_word(keyword.lower(), ("emergency", keyword))
+        automaton.make_automaton()
+        return automaton
+    
+    def _scan_keywords(self, user_input: str) -> Tuple[bool, List[str]]:
+        """
+        Scan user input once for emergency keywords and the user's allergies.
+        Emergency keywords match anywhere; allergies need a word boundary on
+        the left and allow a plural on the right, so "egg" matches "eggs"
+        but not "eggplant".
+        
+        Returns:
+            (emergency keyword found, allergies mentioned)
+        """
+        user_lower = user_input.lower()
+        
+        if self._keyword_automaton is None:
+            allergies = [
+                a for a in self.preferences.get('allergies', [])
+                if re.search(r"(?<!\w)" + re.escape(a.lower()) + _ALLERGY_SUFFIX_RE.pattern, user_lower)
+            ]
+            return bool(_EMERGENCY_RE.search(user_input)), allergies
+        
+        emergency = False
+        allergies = []
+        for end, (kind, word) in self._keyword_automaton.iter(user_lower):
+            if kind == "emergency":
+                emergency = True
+            elif word not in allergies:
+                start = end - len(word.lower()) + 1
+                before = user_lower[start - 1] if start > 0 else " "
+                if not _is_word_char(before) and _ALLERGY_SUFFIX_RE.match(user_lower, end + 1):
+                    allergies.append(word)
+        return emergency, allergies
     
-    def _check_emergency_keywords(self, user_input: str):
+    def _check_emergency_keywords(self, user_input: str) -> bool:
         """
         Step 23: Emergency Guardrails
-        Check for emergency keywords and respond appropriately
+        Check for emergency keywords and respond appropriately.
+        Also warns when the user mentions one of their own allergies.
         """
-        emergency_keywords = [
-            "anorexia", "suicide", "severe pain", "chest pain", 
-            "heart attack", "stroke", "emergency", "dying"
-        ]
+        emergency, allergies = self._scan_keywords(user_input)
         
-        user_lower = user_input.lower()
-        for keyword in emergency_keywords:
-            if keyword in user_lower:
-                print("\n" + "="*80)
-                print("⚠️  EMERGENCY ALERT")
-                print("="*80)
-                print("""
+        if allergies and not emergency:
+            print(f"⚠️  Note: you mentioned {', '.join(allergies)}, which is in your allergy list.")
+        
+        if emergency:
+            print("\n" + "="*80)
+            print("⚠️  EMERGENCY ALERT")
+            print("="*80)
+            print("""
 This assistant cannot provide emergency medical assistance. 
 If you are experiencing a medical emergency, please:
 - Call 911 (or your local emergency number) immediately
@@ -224,9 +438,9 @@ If you are experiencing a medical emergency, please:
 For mental health emergencies, contact:
 - National Suicide Prevention Lifeline: 988
 - Crisis Text Line: Text HOME to 741741
-                """)
-                print("="*80)
-                return True
+            """)
+            print("="*80)
+            return True
         return False
     
     def chat(self, user_message: str):
@@ -242,25 +456,46 @@ For mental health emergencies, contact:
         max_tokens = int(self.config['llm']['max_tokens'])
         repeat_penalty = float(self.config['llm']['repeat_penalty'])
         
-        # Generate response with streaming enabled
-        response = self.llm.create_chat_completion(
-            messages=messages,
-            temperature=temperature,
-            max_tokens=max_tokens,
-            repeat_penalty=repeat_penalty,
-            stream=True
-        )
+        # Generate response with streaming enabled. With a chat template the
+        # prompt is passed as token ids so the static prefix is not re-tokenized
+        # every turn; KV-cache reuse of a matching prefix is unchanged.
+        if self._chat_formatter is not None:
+            prompt_tokens, formatted = self._prompt_tokens(self._chat_formatter, messages)
+            response = self.llm.create_completion(
+                prompt=prompt_tokens,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                repeat_penalty=repeat_penalty,
+                stop=formatted.stop,
+                stopping_criteria=formatted.stopping_criteria,
+                stream=True
+            )
+        else:
+            response = self.llm.create_chat_completion(
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                repeat_penalty=repeat_penalty,
+                stream=True
+            )
         
-        # Collect and display streaming response
-        assistant_message = ""
+        # Collect and display streaming response, flushing stdout at most every 50ms
+        parts = []
+        last_flush = time.monotonic()
         for chunk in response:
-            delta = chunk['choices'][0]['delta']
-            if 'content' in delta:
-                token = delta['content']
-                print(token, end="", flush=True)
-                assistant_message += token
+            choice = chunk['choices'][0]
+            token = choice['text'] if 'text' in choice else choice['delta'].get('content')
+            if token:
+                parts.append(token)
+                sys.stdout.write(token)
+                now = time.monotonic()
+                if now - last_flush > 0.05:
+                    sys.stdout.flush()
+                    last_flush = now
         
-        print()  # New line after streaming completes
+        sys.stdout.write("\n")  # New line after streaming completes
+        sys.stdout.flush()
+        assistant_message = "".join(parts)
         
         # Update memory (Step 11: Update Memory Buffer)
         self.memory_manager.add_message("user", user_message)
@@ -281,26 +516,19 @@ For mental health emergencies, contact:
         # Display disclaimer
         self._display_disclaimer()
         
-        # Welcome message
-        print("\n" + "="*80)
-        print("🍎 Welcome to DietAI - Your Personal Dietary Assistant")
-        print("="*80)
+        # Welcome message, assembled and written in one call
+        parts = [WELCOME_HEADER]
         
         # Display user profile
         if self.preferences:
-            print("\n📋 Your Profile:")
-            print(f"   Diet: {self.preferences.get('dietary_style', 'Not set')}")
+            parts.append("\n📋 Your Profile:\n")
+            parts.append(f"   Diet: {self.preferences.get('dietary_style', 'Not set')}\n")
             if self.preferences.get('allergies'):
-                print(f"   Allergies: {', '.join(self.preferences.get('allergies', []))}")
-            print()
+                parts.append(f"   Allergies: {', '.join(self.preferences.get('allergies', []))}\n")
+            parts.append("\n")
         
-        print("💬 Ask me anything about diet, nutrition, meal planning, or recipes!")
-        print("\n📝 Commands:")
-        print("   /exit    - End conversation and save session")
-        print("   /clear   - Clear current session memory")
-        print("   /history - View conversation history")
-        print("   /goals   - View your preferences and blood report")
-        print()
+        parts.append(WELCOME_COMMANDS)
+        sys.stdout.write("".join(parts))
         
         # Main conversation loop
         while True:
@@ -315,6 +543,7 @@ For mental health emergencies, contact:
                     if user_input.lower() == '/exit':
                         print("\n[System: Saving session...]")
                         self.memory_manager.save_to_long_term_memory(self.llm)
+                        self.memory_manager.close()
                         print("\n👋 Thanks for using DietAI! Stay healthy!")
                         break
                     
@@ -338,7 +567,10 @@ For mental health emergencies, contact:
                         print("="*80)
                         if self.preferences:
                             print("\nPreferences:")
-                            print(json.dumps(self.preferences, indent=2))
+                            if orjson:
+                                print(orjson.dumps(self.preferences, option=orjson.OPT_INDENT_2).decode())
+                            else:
+                                print(json.dumps(self.preferences, indent=2))
                         if self.blood_report:
                             print("\nBlood Report Summary:")
                             print(self.blood_report)
@@ -362,6 +594,7 @@ For mental health emergencies, contact:
             except KeyboardInterrupt:
                 print("\n\n[System: Saving session...]")
                 self.memory_manager.save_to_long_term_memory(self.llm)
+                self.memory_manager.close()
                 print("👋 Thanks for using DietAI! Stay healthy!")
                 break
             except Exception as e:
@@ -5,13 +5,45 @@ Implements Phase 3: Memory Management System
 This module handles:
 - Message counter tracking
 - Short-term memory summarization
-- Long-term memory management
+- Long-term memory management (SQLite)
 """
 
 import configparser
+import json
+import re
+import sqlite3
+from collections import deque
 from datetime import datetime
 from pathlib import Path
-from typing import List, Dict
+from typing import Deque, Dict, List, Optional, Tuple
+
+from llama_cpp import LlamaGrammar
+
+
+# GBNF grammars that force summaries into compact JSON objects, which keeps
+# the number of generated (decoded) tokens small
+_GBNF_COMMON = r'''
+list ::= "[" ws ( string ( "," ws string )* )? ws "]"
+string ::= "\"" ( [^"\\\n] | "\\" ["\\/bfnrt] )* "\""
+ws ::= [ \t\n]?
+'''
+
+SHORT_TERM_SUMMARY_GBNF = r'''
+root ::= "{" ws "\"meals\":" ws list "," ws "\"prefs\":" ws list "," ws "\"macros\":" ws string ws "}"
+''' + _GBNF_COMMON
+
+LONG_TERM_SUMMARY_GBNF = r'''
+root ::= "{" ws "\"trends\":" ws list "," ws "\"macros\":" ws string "," ws "\"recommendations\":" ws list "," ws "\"notes\":" ws list ws "}"
+''' + _GBNF_COMMON
+
+# Display labels for the JSON summary fields, in output order
+SHORT_TERM_SUMMARY_LABELS = {"meals": "Meals", "prefs": "Preferences", "macros": "Macros (C/P/F)"}
+LONG_TERM_SUMMARY_LABELS = {
+    "trends": "Dietary Trends",
+    "macros": "Macro Compliance",
+    "recommendations": "Recommendations",
+    "notes": "Health Notes",
+}
 
 
 class MemoryManager:
@@ -38,23 +70,49 @@ class MemoryManager:
         base_path = Path(__file__).parent
         self.memory_dir = base_path / config.get('paths', 'memory', fallback='memory')
         self.short_term_file = self.memory_dir / 'short_term_memory.txt'
+        self.long_term_db_file = self.memory_dir / 'memory.db'
+        # Legacy text store, imported into the database once if present
         self.long_term_file = self.memory_dir / 'long_term_memory.txt'
         
         # Get memory settings from config
         self.short_term_limit = config.getint('memory', 'short_term_limit', fallback=10)
         self.long_term_sessions = config.getint('memory', 'long_term_sessions', fallback=3)
+        # Batches shorter than this are stored verbatim instead of being summarized
+        self.min_summary_chars = config.getint('memory', 'min_summary_chars', fallback=400)
         
         # Step 7: Initialize message counter
         self.message_counter = 0
         
+        # Summaries in short_term_file (header stripped), read lazily and reset to None on every write
+        self._short_term_file_cache: Optional[str] = None
+        
+        # Shared system prompt for all summarization calls. Keeping messages[0]
+        # identical lets llama.cpp reuse the cached prefix instead of re-prefilling.
+        self.summary_system_prompt = (
+            "You are a helpful assistant that summarizes dietary conversations "
+            "and creates comprehensive dietary summaries."
+        )
+        
+        # Grammars are compiled once and reused for every summarization call
+        self.short_term_grammar = LlamaGrammar.from_string(SHORT_TERM_SUMMARY_GBNF, verbose=False)
+        self.long_term_grammar = LlamaGrammar.from_string(LONG_TERM_SUMMARY_GBNF, verbose=False)
+        
         # Buffer to store raw messages before summarization
-        self.message_buffer: List[Dict[str, str]] = []
+        # (bounded: one user + one assistant message per counted turn)
+        self.message_buffer: Deque[Dict[str, str]] = deque(maxlen=self.short_term_limit * 2)
         
         # Ensure memory directory exists
         self.memory_dir.mkdir(exist_ok=True)
         
         # Step 6: Ensure memory files exist
         self._ensure_memory_files()
+        
+        # Long-lived append handle for summaries (avoids reopening per write)
+        self._short_term_fp = open(self.short_term_file, 'a', encoding='utf-8')
+        
+        # Step 9: Long-term memory lives in SQLite, indexed by timestamp
+        self.db = sqlite3.connect(self.long_term_db_file)
+        self._init_long_term_db()
     
     def _ensure_memory_files(self):
         """Step 6: Ensure memory files exist, create them if they don't."""
@@ -62,11 +120,66 @@ class MemoryManager:
             with open(self.short_term_file, 'w') as f:
                 f.write("# Short-term memory for current session\n")
                 f.write("# Stores up to 10 message pairs before summarization\n\n")
+    
+    def _init_long_term_db(self):
+        """Create the sessions table and migrate long_term_memory.txt if it exists."""
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, ts TEXT NOT NULL, summary TEXT NOT NULL)"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS sessions_ts ON sessions (ts)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS migrations (name TEXT PRIMARY KEY)")
+        
+        if self.long_term_file.exists():
+            self._migrate_long_term_file()
+    
+    def _migrate_long_term_file(self) -> None:
+        """
+        One-time import of session summaries from the legacy long_term_memory.txt.
+        
+        The sessions and a migration marker are committed in one transaction,
+        so a retry (e.g. after a failed rename) never imports rows twice. The
+        text file is then renamed to long_term_memory.txt.migrated and the
+        stale long_term_memory.idx offset index is deleted.
+        """
+        done: Optional[Tuple[int]] = self.db.execute(
+            "SELECT 1 FROM migrations WHERE name = ?", ('long_term_txt',)
+        ).fetchone()
         
-        if not self.long_term_file.exists():
-            with open(self.long_term_file, 'w') as f:
-                f.write("# Long-term memory for previous sessions\n")
-                f.write("# Stores summaries of past conversations\n\n")
+        if not done:
+            with open(self.long_term_file, 'r', encoding='utf-8') as f:
+                content = f.read()
+            
+            sessions = re.findall(
+                r"^=== Session Summary \([^)]*\) - (.+?) ===\n(.*?)\n={60}$",
+                content, re.MULTILINE | re.DOTALL
+            )
+            with self.db:
+                self.db.executemany(
+                    "INSERT INTO sessions (ts, summary) VALUES (?, ?)",
+                    [(ts, summary.strip()) for ts, summary in sessions]
+                )
+                self.db.execute("INSERT INTO migrations (name) VALUES (?)", ('long_term_txt',))
+        
+        try:
+            self.long_term_file.rename(self.long_term_file.with_name('long_term_memory.txt.migrated'))
+            (self.memory_dir / 'long_term_memory.idx').unlink(missing_ok=True)
+        except OSError as e:
+            print(f"⚠️  Could not archive long_term_memory.txt: {e}")
+    
+    @staticmethod
+    def _strip_header(content: str) -> str:
+        """Remove the leading '#' header lines from a memory file's content."""
+        lines = content.split("\n")
+        while lines and lines[0].startswith("#"):
+            lines.pop(0)
+        return "\n".join(lines).strip()
+    
+    @staticmethod
+    def _format_session(ts: str, summary: str) -> str:
+        """Format a stored session summary with its header and footer."""
+        return f"=== Session Summary ({ts[:10]}) - {ts} ===\n{summary}\n" + "=" * 60
     
     def add_message(self, role: str, content: str):
         """
@@ -95,8 +208,10 @@ class MemoryManager:
         """
         Step 8: Create Short-Term Memory Summarization.
         
-        Collects the last 10 raw messages (5 user inputs, 5 assistant responses),
+        Collects the buffered raw messages (up to short_term_limit user inputs
+        and their assistant responses),
         sends to LLM for summarization, and appends to short_term_memory.txt.
+        Batches shorter than min_summary_chars are appended verbatim instead.
         
         Args:
             llm: Initialized Llama model instance
@@ -107,57 +222,95 @@ class MemoryManager:
         if not self.message_buffer:
             return ""
         
-        # Collect the last messages (up to the limit)
-        messages_to_summarize = self.message_buffer[-self.short_term_limit:]
+        # Collect every buffered message (the deque already caps this at
+        # short_term_limit user/assistant pairs)
+        messages_to_summarize = list(self.message_buffer)
         
         # Format the conversation transcript
-        transcript = "Conversation Transcript:\n"
-        for msg in messages_to_summarize:
-            role_label = "User" if msg["role"] == "user" else "Assistant"
-            transcript += f"{role_label}: {msg['content']}\n"
-        
-        # Create summarization prompt
-        summarization_prompt = (
-            "Summarize this conversation batch, focusing on meals discussed, "
-            "any new preferences/allergies mentioned, and the recommended macro split.\n\n"
-            f"{transcript}\n\n"
-            "Provide a concise summary:"
-        )
-        
-        # Get summary from LLM
-        messages = [
-            {"role": "system", "content": "You are a helpful assistant that summarizes dietary conversations."},
-            {"role": "user", "content": summarization_prompt}
-        ]
-        
-        response = llm.create_chat_completion(
-            messages=messages,
-            max_tokens=512,
-            temperature=0.3,
-            stream=False
+        transcript = "\n".join(
+            f"{'User' if msg['role'] == 'user' else 'Assistant'}: {msg['content']}"
+            for msg in messages_to_summarize
         )
         
-        summary = response['choices'][0]['message']['content']
+        # Trivial batches are cheaper to keep verbatim than to decode a summary for
+        total_chars = sum(len(msg['content']) for msg in messages_to_summarize)
+        if total_chars < self.min_summary_chars:
+            summary = transcript
+        else:
+            # Create summarization prompt
+            summarization_prompt = (
+                "Summarize this conversation batch, focusing on meals discussed, "
+                "any new preferences/allergies mentioned, and the recommended macro split.\n\n"
+                f"Conversation Transcript:\n{transcript}\n\n\n"
+                "Respond with JSON: \"meals\" (list), \"prefs\" (list of preferences/allergies), "
+                "\"macros\" (recommended split as \"C/P/F\")."
+            )
+            
+            # Get summary from LLM
+            messages = [
+                {"role": "system", "content": self.summary_system_prompt},
+                {"role": "user", "content": summarization_prompt}
+            ]
+            
+            response = llm.create_chat_completion(
+                messages=messages,
+                max_tokens=512,
+                temperature=0.3,
+                stream=False,
+                grammar=self.short_term_grammar
+            )
+            
+            summary = self._format_structured_summary(
+                response['choices'][0]['message']['content'], SHORT_TERM_SUMMARY_LABELS
+            )
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         
         # Append summary to short_term_memory.txt
-        with open(self.short_term_file, 'a', encoding='utf-8') as f:
-            f.write(f"\n--- Summary ({timestamp}) ---\n")
-            f.write(f"{summary}\n")
-            f.write("-" * 50 + "\n")
+        self._short_term_fp.write(f"\n--- Summary ({timestamp}) ---\n")
+        self._short_term_fp.write(f"{summary}\n")
+        self._short_term_fp.write("-" * 50 + "\n")
+        self._short_term_fp.flush()
+        self._short_term_file_cache = None
         
         # Clear the message buffer and reset counter
-        self.message_buffer = []
+        self.message_buffer.clear()
         self.message_counter = 0
         
         return summary
     
+    def _format_structured_summary(self, raw: str, labels: Dict[str, str]) -> str:
+        """
+        Parse a grammar-constrained JSON summary into labelled lines.
+        
+        Args:
+            raw: JSON text returned by the LLM
+            labels: Mapping of JSON keys to display labels
+            
+        Returns:
+            Formatted summary text, or the raw text if it is not valid JSON
+            (e.g. generation stopped at max_tokens)
+        """
+        try:
+            data = json.loads(raw)
+        except json.JSONDecodeError:
+            return raw.strip()
+        
+        lines = []
+        for key, label in labels.items():
+            value = data.get(key)
+            if isinstance(value, list):
+                value = "; ".join(value)
+            if value:
+                lines.append(f"{label}: {value}")
+        
+        return "\n".join(lines)
+    
     def save_to_long_term_memory(self, llm):
         """
         Step 9: End of Conversation - Save to Long-Term Memory.
         
         Reads all content from short_term_memory.txt, sends to LLM for
-        comprehensive summarization, appends to long_term_memory.txt,
+        comprehensive summarization, stores it in the long-term sessions table,
         and clears short_term_memory.txt.
         
         Args:
@@ -168,9 +321,9 @@ class MemoryManager:
             return
         
         with open(self.short_term_file, 'r', encoding='utf-8') as f:
-            short_term_content = f.read()
+            short_term_content = self._strip_header(f.read())
         
-        if not short_term_content.strip() or short_term_content.strip().startswith("#"):
+        if not short_term_content:
             # No meaningful content to summarize
             return
         
@@ -183,12 +336,14 @@ class MemoryManager:
             "- Key dietary trends and patterns\n"
             "- Macro compliance over time\n"
             "- Persistent recommendations and preferences\n"
-            "- Important health-related notes:"
+            "- Important health-related notes\n\n"
+            "Respond with JSON: \"trends\" (list), \"macros\" (compliance summary), "
+            "\"recommendations\" (list), \"notes\" (list)."
         )
         
         # Get comprehensive summary from LLM
         messages = [
-            {"role": "system", "content": "You are a helpful assistant that creates comprehensive dietary summaries."},
+            {"role": "system", "content": self.summary_system_prompt},
             {"role": "user", "content": summarization_prompt}
         ]
         
@@ -196,78 +351,59 @@ class MemoryManager:
             messages=messages,
             max_tokens=1024,
             temperature=0.3,
-            stream=False
+            stream=False,
+            grammar=self.long_term_grammar
         )
         
-        comprehensive_summary = response['choices'][0]['message']['content']
-        session_date = datetime.now().strftime("%Y-%m-%d")
+        comprehensive_summary = self._format_structured_summary(
+            response['choices'][0]['message']['content'], LONG_TERM_SUMMARY_LABELS
+        )
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         
-        # Append comprehensive summary to long_term_memory.txt
-        with open(self.long_term_file, 'a', encoding='utf-8') as f:
-            f.write(f"\n=== Session Summary ({session_date}) - {timestamp} ===\n")
-            f.write(f"{comprehensive_summary}\n")
-            f.write("=" * 60 + "\n")
+        # Store comprehensive summary as one long-term session row
+        with self.db:
+            self.db.execute(
+                "INSERT INTO sessions (ts, summary) VALUES (?, ?)",
+                (timestamp, comprehensive_summary)
+            )
         
         # Clear short_term_memory.txt (keep header)
+        self._short_term_fp.close()
         with open(self.short_term_file, 'w', encoding='utf-8') as f:
             f.write("# Short-term memory for current session\n")
             f.write("# Stores up to 10 message pairs before summarization\n\n")
+        self._short_term_fp = open(self.short_term_file, 'a', encoding='utf-8')
+        self._short_term_file_cache = None
         
         # Clear message buffer and reset counter
-        self.message_buffer = []
+        self.message_buffer.clear()
         self.message_counter = 0
     
     def load_long_term_memory_context(self) -> str:
         """
         Step 9: Start of Conversation - Load Long-Term Memory Context.
         
-        Reads memory/long_term_memory.txt, extracts the last 2-3 session summaries,
+        Fetches the last 2-3 session summaries from the sessions table
         and formats them as context for the new conversation's system prompt.
         
         Returns:
             Formatted long-term memory context string
         """
-        if not self.long_term_file.exists():
-            return ""
-        
-        with open(self.long_term_file, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        if not content.strip() or content.strip().startswith("#"):
-            return ""
+        # Get the last N sessions (from config), newest first
+        rows: List[Tuple[str, str]] = self.db.execute(
+            "SELECT ts, summary FROM sessions ORDER BY ts DESC, id DESC LIMIT ?",
+            (self.long_term_sessions,)
+        ).fetchall()
         
-        # Extract session summaries (sections between === markers)
-        sessions = []
-        current_session = []
-        in_session = False
-        
-        for line in content.split('\n'):
-            if line.startswith('===') and 'Session Summary' in line:
-                if current_session and in_session:
-                    sessions.append('\n'.join(current_session))
-                current_session = [line]
-                in_session = True
-            elif in_session:
-                current_session.append(line)
-                if line.startswith('=' * 60):
-                    sessions.append('\n'.join(current_session))
-                    current_session = []
-                    in_session = False
-        
-        # Get the last N sessions (from config)
-        recent_sessions = sessions[-self.long_term_sessions:] if sessions else []
-        
-        if not recent_sessions:
+        if not rows:
             return ""
         
-        # Format as context
-        context = "Previous Session Summaries:\n"
-        context += "-" * 60 + "\n"
-        for session in recent_sessions:
-            context += f"{session}\n\n"
+        # Format as context, oldest first
+        parts = ["Previous Session Summaries:\n", "-" * 60 + "\n"]
+        for ts, summary in reversed(rows):
+            parts.append(f"{self._format_session(ts, summary)}\n\n")
         
-        return context
+        return "".join(parts)
     
     def get_short_term_memory_context(self) -> str:
         """
@@ -277,53 +413,64 @@ class MemoryManager:
             Formatted short-term memory context string
         """
         if not self.message_buffer:
-            # Try to read from file if buffer is empty
-            if self.short_term_file.exists():
-                with open(self.short_term_file, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                # Return only summaries, not the header
-                if content and not content.strip().startswith("#"):
-                    return content
-            return ""
+            # Try to read from file if buffer is empty (cached until the next write);
+            # only the summaries are kept, not the header
+            if self._short_term_file_cache is None:
+                self._short_term_file_cache = ""
+                if self.short_term_file.exists():
+                    with open(self.short_term_file, 'r', encoding='utf-8') as f:
+                        self._short_term_file_cache = self._strip_header(f.read())
+            return self._short_term_file_cache
         
         # Format current buffer
-        context = "Current Session Messages:\n"
-        for msg in self.message_buffer:
-            role_label = "User" if msg["role"] == "user" else "Assistant"
-            context += f"{role_label}: {msg['content']}\n"
+        transcript = "\n".join(
+            f"{'User' if msg['role'] == 'user' else 'Assistant'}: {msg['content']}"
+            for msg in self.message_buffer
+        )
         
-        return context
+        return f"Current Session Messages:\n{transcript}\n"
     
     def clear_short_term_memory(self):
         """
-        Clear current session (short_term_memory.txt) but preserve long_term_memory.txt.
+        Clear current session (short_term_memory.txt) but preserve long-term memory.
         Used by /clear command.
         """
         # Clear buffer and counter
-        self.message_buffer = []
+        self.message_buffer.clear()
         self.message_counter = 0
         
         # Clear file (keep header)
+        self._short_term_fp.close()
         with open(self.short_term_file, 'w', encoding='utf-8') as f:
             f.write("# Short-term memory for current session\n")
             f.write("# Stores up to 10 message pairs before summarization\n\n")
+        self._short_term_fp = open(self.short_term_file, 'a', encoding='utf-8')
+        self._short_term_file_cache = None
     
     def get_long_term_history(self) -> str:
         """
-        Get all summaries from long_term_memory.txt.
+        Get all session summaries from long-term memory.
         Used by /history command.
         
         Returns:
             All long-term memory content
         """
-        if not self.long_term_file.exists():
-            return "No long-term memory found."
-        
-        with open(self.long_term_file, 'r', encoding='utf-8') as f:
-            content = f.read()
+        rows: List[Tuple[str, str]] = self.db.execute(
+            "SELECT ts, summary FROM sessions ORDER BY ts, id"
+        ).fetchall()
         
-        if not content.strip() or content.strip().startswith("#"):
+        if not rows:
             return "No previous session summaries found."
         
-        return content
-
+        return "\n\n".join(self._format_session(ts, summary) for ts, summary in rows)
+    
+    def close(self):
+        """Close the short-term memory file handle and the long-term database."""
+        if not self._short_term_fp.closed:
+            self._short_term_fp.close()
+        if hasattr(self, 'db'):
+            self.db.close()
+    
+    def __del__(self):
+        if hasattr(self, '_short_term_fp'):
+            self.close()